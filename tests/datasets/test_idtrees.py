@@ -2,22 +2,34 @@
 # Licensed under the MIT License.
 
 import glob
+import math
 import os
 import shutil
+import sys
 from pathlib import Path
+from typing import NamedTuple
 
 import matplotlib.pyplot as plt
+import pandas as pd
 import pytest
+import rasterio
 import torch
 import torch.nn as nn
 from _pytest.fixtures import SubRequest
 from pytest import MonkeyPatch
+from rasterio.coords import BoundingBox
+from torch.utils.data import DataLoader
 
-from torchgeo.datasets import DatasetNotFoundError, IDTReeS
+from torchgeo.datasets import DatasetNotFoundError, IDTReeS, IDTReeSPrefetcher
 
 pytest.importorskip('laspy', minversion='2')
 
 
+class Batch(NamedTuple):
+    samples: list[dict[str, torch.Tensor]]
+    size: int
+
+
 class TestIDTReeS:
     @pytest.fixture(params=zip(['train', 'test', 'test'], ['task1', 'task1', 'task2']))
     def dataset(
@@ -50,10 +62,10 @@ class TestIDTReeS:
         assert isinstance(x['hsi'], torch.Tensor)
         assert isinstance(x['las'], torch.Tensor)
         assert x['image'].shape == (3, 200, 200)
-        assert x['chm'].shape == (1, 200, 200)
-        assert x['hsi'].shape == (369, 200, 200)
-        assert x['las'].ndim == 2
-        assert x['las'].shape[0] == 3
+        assert x['chm'].shape == (1, 20, 20)
+        assert x['hsi'].shape == (369, 20, 20)
+        # Two of the four points in each fixture lie under the RGB image
+        assert x['las'].shape == (3, 2)
 
         if 'label' in x:
             assert isinstance(x['label'], torch.Tensor)
@@ -63,6 +75,96 @@ class TestIDTReeS:
                 assert x['boxes'].ndim == 2
                 assert x['boxes'].shape[-1] == 4
 
+    def test_cache(self, dataset: IDTReeS, monkeypatch: MonkeyPatch) -> None:
+        IDTReeS(dataset.root, dataset.split, dataset.task, cache=True)
+        for pattern in ['RGB/*_200x200.npy', 'RGB/*.json', 'LAS/*.pt']:
+            pathname = os.path.join(dataset.root, '**', pattern)
+            assert len(glob.glob(pathname, recursive=True)) == len(dataset)
+        pathname = os.path.join(dataset.root, '**', '*.tmp')
+        assert not glob.glob(pathname, recursive=True)
+
+        # Once cached, no GeoTIFF is opened
+        with monkeypatch.context() as m:
+            m.setattr(rasterio, 'open', None)
+            ds = IDTReeS(dataset.root, dataset.split, dataset.task, cache=True)
+            x = ds[0]
+        y = dataset[0]
+        assert x.keys() == y.keys()
+        for key in x:
+            assert torch.equal(x[key], y[key])
+
+        # Images cached at another size are not reused
+        image_sizes = {'RGB': (2, 2), 'HSI': (2, 2), 'CHM': (2, 2)}
+        monkeypatch.setattr(ds, 'image_sizes', image_sizes)
+        x = ds[0]
+        assert x['image'].shape == (3, 2, 2)
+        assert x['hsi'].shape == (369, 2, 2)
+        assert x['chm'].shape == (1, 2, 2)
+
+    def test_prefetcher(self, dataset: IDTReeS) -> None:
+        loader = DataLoader(dataset, batch_size=2, collate_fn=lambda x: (x, len(x)))
+        prefetcher = IDTReeSPrefetcher(loader, device='cpu')
+        assert len(prefetcher) == 2
+        batches = list(prefetcher)
+        assert len(batches) == 2
+        assert isinstance(batches[0], tuple)
+        samples, batch_size = batches[0]
+        assert batch_size == 2
+        assert samples[0]['image'].device == torch.device('cpu')
+
+    def test_prefetcher_namedtuple(self, dataset: IDTReeS) -> None:
+        loader = DataLoader(
+            dataset, batch_size=2, collate_fn=lambda x: Batch(x, len(x))
+        )
+        batch = next(iter(IDTReeSPrefetcher(loader, device='cpu')))
+        assert isinstance(batch, Batch)
+        assert batch.size == 2
+
+    @pytest.mark.skipif(not torch.cuda.is_available(), reason='requires CUDA')
+    def test_prefetcher_cuda(self, dataset: IDTReeS) -> None:
+        loader = DataLoader(
+            dataset, batch_size=2, collate_fn=lambda x: (x, len(x)), pin_memory=True
+        )
+        prefetcher = IDTReeSPrefetcher(loader, device='cuda', channels_last=True)
+        batches = list(prefetcher)
+        assert len(batches) == 2
+        for i, (samples, _) in enumerate(batches):
+            for j, sample in enumerate(samples):
+                expected = dataset[2 * i + j]
+                for key, value in sample.items():
+                    assert value.is_cuda
+                    assert torch.equal(value.cpu(), expected[key])
+
+    def test_without_pyogrio(self, dataset: IDTReeS, monkeypatch: MonkeyPatch) -> None:
+        monkeypatch.setitem(sys.modules, 'pyogrio.raw', None)
+        ds = IDTReeS(dataset.root, dataset.split, dataset.task)
+        x = ds[0]
+        y = dataset[0]
+        if 'boxes' in x:
+            assert torch.equal(x['boxes'], y['boxes'])
+
+    def test_native_size(self, dataset: IDTReeS, monkeypatch: MonkeyPatch) -> None:
+        image_sizes = {'RGB': (2, 2), 'HSI': (2, 2), 'CHM': (2, 2)}
+        monkeypatch.setattr(dataset, 'image_sizes', image_sizes)
+        x = dataset[0]
+        assert x['image'].shape == (3, 2, 2)
+        assert x['hsi'].shape == (369, 2, 2)
+        assert x['chm'].shape == (1, 2, 2)
+
+    def test_prefetcher_channels_last(self, dataset: IDTReeS) -> None:
+        loader = DataLoader(dataset, batch_size=1)
+        prefetcher = IDTReeSPrefetcher(loader, device='cpu', channels_last=True)
+        batch = next(iter(prefetcher))
+        assert batch['image'].is_contiguous(memory_format=torch.channels_last)
+        assert batch['hsi'].is_contiguous(memory_format=torch.channels_last)
+
+    def test_las_bounds(self, dataset: IDTReeS) -> None:
+        path = dataset.las_paths[0]
+        bounds = BoundingBox(-math.inf, -math.inf, math.inf, math.inf)
+        assert dataset._load_las(path, bounds).shape == (3, 4)
+        bounds = BoundingBox(0, 0, 0, 0)
+        assert dataset._load_las(path, bounds).shape == (3, 0)
+
     def test_len(self, dataset: IDTReeS) -> None:
         assert len(dataset) == 3
 
@@ -80,6 +182,53 @@ class TestIDTReeS:
             shutil.copy(zipfile, root)
         IDTReeS(root)
 
+    def test_rgb_in_root(self, tmp_path: Path) -> None:
+        pathname = os.path.join('tests', 'data', 'idtrees', '*.zip')
+        root = tmp_path / 'RGB'
+        root.mkdir()
+        for zipfile in glob.iglob(pathname):
+            shutil.copy(zipfile, root)
+        dataset = IDTReeS(root)
+        dataset[0]
+
+    def test_unmapped_labels(self, tmp_path: Path) -> None:
+        pathname = os.path.join(
+            'tests', 'data', 'idtrees', 'IDTREES_competition_train_v2.zip'
+        )
+        shutil.copy(pathname, tmp_path)
+        dataset = IDTReeS(tmp_path)
+        expected = [dataset[i]['boxes'] for i in range(len(dataset))]
+
+        # Add an individual that is not mapped to an image, and one that is mapped
+        # to an image but has no geometry in the shapefiles
+        path_labels = tmp_path / 'train' / 'Field' / 'train_data.csv'
+        path_mapping = tmp_path / 'train' / 'Field' / 'itc_rsFile.csv'
+        df_labels = pd.read_csv(path_labels)
+        df_mapping = pd.read_csv(path_mapping)
+        rows = df_labels.iloc[[0, 0]].assign(indvdID=['UNMAPPED', 'NOGEOMETRY'])
+        row = {'id': df_mapping['id'].max() + 1, 'indvdID': 'NOGEOMETRY'}
+        row['rsFile'] = os.path.basename(dataset.images[0])
+        pd.concat([df_labels, rows]).to_csv(path_labels, index=False)
+        pd.concat([df_mapping, pd.DataFrame([row])]).to_csv(path_mapping, index=False)
+
+        dataset = IDTReeS(tmp_path)
+        for i in range(len(dataset)):
+            assert torch.equal(dataset[i]['boxes'], expected[i])
+
+    def test_duplicate_labels(self, tmp_path: Path) -> None:
+        pathname = os.path.join(
+            'tests', 'data', 'idtrees', 'IDTREES_competition_train_v2.zip'
+        )
+        shutil.copy(pathname, tmp_path)
+        dataset = IDTReeS(tmp_path)
+        filenames = [os.path.basename(path) for path in dataset.images]
+        x = dataset[filenames.index('MLBS_1.tif')]
+
+        # Two trees in MLBS_1 were surveyed twice, each tree only has one box
+        assert x['boxes'].shape == (21, 4)
+        assert x['label'].shape == (21,)
+        assert len(torch.unique(x['boxes'], dim=0)) == 21
+
     def test_plot(self, dataset: IDTReeS) -> None:
         x = dataset[0].copy()
         dataset.plot(x, suptitle='Test')
@@ -102,4 +251,5 @@ class TestIDTReeS:
 
         # Test point cloud without colors
         point_cloud = dataset.plot_las(index=0)
+        assert point_cloud.n_points == dataset[0]['las'].shape[1]
         pyvista.plot(point_cloud, scalars=point_cloud.points, cpos='yz', cmap='viridis')
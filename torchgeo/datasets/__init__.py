@@ -62,7 +62,7 @@ from .geonrw import GeoNRW
 from .gid15 import GID15
 from .globbiomass import GlobBiomass
 from .hyspecnet import HySpecNet11k
-from .idtrees import IDTReeS
+from .idtrees import IDTReeS, IDTReeSPrefetcher
 from .inaturalist import INaturalist
 from .inria import InriaAerialImageLabeling
 from .iobench import IOBench
@@ -218,6 +218,7 @@ __all__ = (
     'GlobBiomass',
     'HySpecNet11k',
     'IDTReeS',
+    'IDTReeSPrefetcher',
     'INaturalist',
     'IOBench',
     'InriaAerialImageLabeling',
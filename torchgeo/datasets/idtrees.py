@@ -4,8 +4,10 @@
 """IDTReeS dataset."""
 
 import glob
+import json
 import os
-from collections.abc import Callable
+from collections.abc import Callable, Iterator, Mapping
+from contextlib import ExitStack
 from typing import Any, ClassVar, cast, overload
 
 import fiona
@@ -15,12 +17,16 @@ import pandas as pd
 import rasterio
 import torch
 from matplotlib.figure import Figure
+from rasterio.coords import BoundingBox
 from rasterio.enums import Resampling
+from rasterio.io import DatasetReader
+from rasterio.transform import Affine
+from shapely import wkb
 from torch import Tensor
-from torchvision.ops import clip_boxes_to_image, remove_small_boxes
+from torch.utils.data import DataLoader
 from torchvision.utils import draw_bounding_boxes
 
-from .errors import DatasetNotFoundError
+from .errors import DatasetNotFoundError, DependencyNotFoundError
 from .geo import NonGeoDataset
 from .utils import Path, download_url, extract_archive, lazy_import
 
@@ -97,7 +103,23 @@ class IDTReeS(NonGeoDataset):
        * `laspy <https://pypi.org/project/laspy/>`_ to read lidar point clouds
        * `pyvista <https://pypi.org/project/pyvista/>`_ to plot lidar point clouds
 
+    If `pyogrio <https://pypi.org/project/pyogrio/>`_ is installed, it is used to
+    read the shapefiles in bulk, otherwise they are read one feature at a time
+    with fiona.
+
+    Loading is dominated by reading GeoTIFF and LAS files. When training on a GPU,
+    wrap the :class:`~torch.utils.data.DataLoader` in an :class:`IDTReeSPrefetcher`
+    to overlap host to device copies of the next batch with compute.
+
     .. versionadded:: 0.2
+
+    .. versionchanged:: 0.7
+       HSI and CHM images are returned at their native 20x20 size instead of being
+       upsampled to 200x200, *image_size* replaced by the per-modality
+       *image_sizes*. Point clouds are cropped to the extent of the RGB image.
+       Trees that were surveyed more than once only have a single box and label.
+       The *geometries* attribute holding the fiona features of each object was
+       removed.
     """
 
     classes: ClassVar[dict[str, str]] = {
@@ -151,7 +173,17 @@ class IDTReeS(NonGeoDataset):
         'train': ['train'],
         'test': ['task1', 'task2'],
     }
-    image_size = (200, 200)
+    image_sizes: ClassVar[dict[str, tuple[int, int]]] = {
+        'RGB': (200, 200),
+        'HSI': (20, 20),
+        'CHM': (20, 20),
+    }
+
+    # GDAL configuration used while reading images, skip listing the sibling files
+    # of each image on open
+    _gdal_config: ClassVar[dict[str, str]] = {
+        'GDAL_DISABLE_READDIR_ON_OPEN': 'EMPTY_DIR'
+    }
 
     def __init__(
         self,
@@ -161,6 +193,7 @@ class IDTReeS(NonGeoDataset):
         transforms: Callable[[dict[str, Tensor]], dict[str, Tensor]] | None = None,
         download: bool = False,
         checksum: bool = False,
+        cache: bool = False,
     ) -> None:
         """Initialize a new IDTReeS dataset instance.
 
@@ -173,10 +206,15 @@ class IDTReeS(NonGeoDataset):
                 entry and returns a transformed version
             download: if True, download dataset and store it in the root directory
             checksum: if True, check the MD5 of the downloaded files (may be slow)
+            cache: if True, decode each image and point cloud once and store it
+                next to the original file for faster loading in later epochs
 
         Raises:
             DatasetNotFoundError: If dataset is not found and *download* is False.
             DependencyNotFoundError: If laspy is not installed.
+
+        .. versionchanged:: 0.7
+           Added *cache* parameter.
         """
         lazy_import('laspy')
 
@@ -189,11 +227,33 @@ class IDTReeS(NonGeoDataset):
         self.transforms = transforms
         self.download = download
         self.checksum = checksum
+        self.cache = cache
         self.class2idx = {c: i for i, c in enumerate(self.classes)}
         self.idx2class = {i: c for i, c in enumerate(self.classes)}
         self.num_classes = len(self.classes)
         self._verify()
-        self.images, self.geometries, self.labels = self._load(root)
+        self.images, geometries, self.labels = self._load(root)
+        self.hsi_paths = [self._sibling_path(path, 'HSI') for path in self.images]
+        self.chm_paths = [self._sibling_path(path, 'CHM') for path in self.images]
+        self.las_paths = [self._sibling_path(path, 'LAS') for path in self.images]
+        self._coords: Tensor | None = None
+        keys = None
+        if geometries is not None:
+            coords, keys = geometries
+            self._coords = torch.from_numpy(coords)
+
+        self._offsets, self._rows, self._targets = self._index_images(keys, self.labels)
+
+        # Per-image lookups are stored as flat tensors in shared memory so that
+        # DataLoader workers share a single copy instead of one per process
+        tensors = [self._offsets, self._rows, self._targets]
+        if self._coords is not None:
+            tensors.append(self._coords)
+        for tensor in tensors:
+            tensor.share_memory_()  # type: ignore[no-untyped-call]
+
+        if self.cache:
+            self._materialize_cache()
 
     def __getitem__(self, index: int) -> dict[str, Tensor]:
         """Return an index within the dataset.
@@ -205,22 +265,39 @@ class IDTReeS(NonGeoDataset):
             data and label at that index
         """
         path = self.images[index]
-        image = self._load_image(path).to(torch.uint8)
-        hsi = self._load_image(path.replace('RGB', 'HSI'))
-        chm = self._load_image(path.replace('RGB', 'CHM'))
-        las = self._load_las(path.replace('RGB', 'LAS').replace('.tif', '.las'))
-        sample = {'image': image, 'hsi': hsi, 'chm': chm, 'las': las}
+
+        with ExitStack() as stack:
+            # With the cache, the georeferencing of the RGB image is known and the
+            # GeoTIFF is not opened at all
+            src: DatasetReader | None = None
+            if self.cache:
+                transform, bounds = self._transforms[index], self._bounds[index]
+            else:
+                # Share a single open dataset for reading pixels, bounds, and
+                # affine transform
+                stack.enter_context(rasterio.Env(**self._gdal_config))
+                src = stack.enter_context(rasterio.open(path))
+                transform, bounds = src.transform, src.bounds
+
+            image = self._load_image(path, 'RGB', src).to(torch.uint8)
+            sample = {'image': image}
+            if self._coords is not None:
+                sample['boxes'] = self._load_boxes(index, transform)
+
+            # The other modalities are read serially, the files are small and
+            # starting threads per sample costs more than it saves
+            sample['hsi'] = self._load_image(self.hsi_paths[index], 'HSI')
+            sample['chm'] = self._load_image(self.chm_paths[index], 'CHM')
+            sample['las'] = self._load_las(self.las_paths[index], bounds)
 
         if self.split == 'test':
             if self.task == 'task2':
-                sample['boxes'] = self._load_boxes(path)
                 h, w = sample['image'].shape[1:]
                 sample['boxes'], _ = self._filter_boxes(
                     image_size=(h, w), min_size=1, boxes=sample['boxes'], labels=None
                 )
         else:
-            sample['boxes'] = self._load_boxes(path)
-            sample['label'] = self._load_target(path)
+            sample['label'] = self._load_target(index)
 
             h, w = sample['image'].shape[1:]
             sample['boxes'], sample['label'] = self._filter_boxes(
@@ -243,108 +320,149 @@ class IDTReeS(NonGeoDataset):
         """
         return len(self.images)
 
-    def _load_image(self, path: Path) -> Tensor:
+    def _load_image(
+        self, path: Path, modality: str, src: DatasetReader | None = None
+    ) -> Tensor:
         """Load a tiff file.
 
         Args:
             path: path to .tif file
+            modality: one of 'RGB', 'HSI', or 'CHM'
+            src: optional already opened dataset for *path*
 
         Returns:
             the image
         """
-        with rasterio.open(path) as f:
-            array = f.read(out_shape=self.image_size, resampling=Resampling.bilinear)
+        cache_path = self._cache_path(path, modality)
+        if self.cache and os.path.exists(cache_path):
+            return torch.from_numpy(np.load(cache_path))
+
+        if src is None:
+            with rasterio.Env(**self._gdal_config), rasterio.open(path) as f:
+                return self._load_image(path, modality, f)
+
+        # Only resample images that are not already at the target size
+        image_size = self.image_sizes[modality]
+        if (src.height, src.width) == tuple(image_size):
+            array = src.read()
+        else:
+            array = src.read(out_shape=image_size, resampling=Resampling.bilinear)
+
+        if self.cache:
+            self._write_cache(cache_path, array)
         tensor = torch.from_numpy(array)
         return tensor
 
-    def _load_las(self, path: Path) -> Tensor:
+    def _load_las(self, path: Path, bounds: BoundingBox) -> Tensor:
         """Load a single point cloud.
 
         Args:
             path: path to .las file
+            bounds: extent of the RGB image, points outside of it are dropped
 
         Returns:
             the point cloud
         """
+        cache_path = self._cache_path(path, 'LAS')
+        if self.cache and os.path.exists(cache_path):
+            tensor: Tensor = torch.load(cache_path, map_location='cpu')
+            return tensor
+
         laspy = lazy_import('laspy')
-        las = laspy.read(path)
-        array: np.typing.NDArray[np.int_] = np.stack([las.x, las.y, las.z], axis=0)
+        with laspy.open(path) as f:
+            las = f.read()
+
+        # Scale the raw integer coordinates straight into the output array instead
+        # of stacking temporary copies of las.x, las.y, and las.z
+        scales, offsets = las.header.scales, las.header.offsets
+        array = np.empty((3, len(las.points)), dtype=np.float64)
+        for i, dim in enumerate(['X', 'Y', 'Z']):
+            np.multiply(las[dim], scales[i], out=array[i])
+            array[i] += offsets[i]
+
+        # Only keep the points under the RGB image
+        array = array[:, self._las_mask(array[0], array[1], bounds)]
+
         tensor = torch.from_numpy(array)
+        if self.cache:
+            self._write_cache(cache_path, tensor)
         return tensor
 
-    def _load_boxes(self, path: Path) -> Tensor:
+    def _las_mask(
+        self,
+        x: np.typing.NDArray[np.float64],
+        y: np.typing.NDArray[np.float64],
+        bounds: BoundingBox,
+    ) -> np.typing.NDArray[np.bool_]:
+        """Find the points of a point cloud that lie under an image.
+
+        Args:
+            x: x coordinates of the points
+            y: y coordinates of the points
+            bounds: extent of the image
+
+        Returns:
+            a boolean mask of the points inside of *bounds*
+        """
+        mask: np.typing.NDArray[np.bool_] = (x >= bounds.left) & (x <= bounds.right)
+        mask &= (y >= bounds.bottom) & (y <= bounds.top)
+        return mask
+
+    def _load_boxes(self, index: int, transform: Affine) -> Tensor:
         """Load object bounding boxes.
 
         Args:
-            path: path to .tif file
+            index: index of the image
+            transform: affine transform of the RGB image at *index*
 
         Returns:
             the bounding boxes
         """
-        base_path = os.path.basename(path)
-        geometries = cast(dict[int, dict[str, Any]], self.geometries)
-
-        # Find object ids and geometries
-        # The train set geometry->image mapping is contained
-        # in the train/Field/itc_rsFile.csv file
-        if self.split == 'train':
-            indices = self.labels['rsFile'] == base_path
-            ids = self.labels[indices]['id'].tolist()
-            geoms = [geometries[i]['geometry']['coordinates'][0][:4] for i in ids]
-        # The test set has no mapping csv. The mapping is inside of the geometry
-        # properties i.e. geom["property"]["plotID"] contains the RGB image filename
-        # Return all geometries with the matching RGB image filename of the sample
-        else:
-            ids = [
-                k
-                for k, v in geometries.items()
-                if v['properties']['plotID'] == base_path
-            ]
-            geoms = [geometries[i]['geometry']['coordinates'][0][:4] for i in ids]
-
-        # Convert to pixel coords
-        boxes = []
-        with rasterio.open(path) as f:
-            for geom in geoms:
-                coords = [f.index(x, y) for x, y in geom]
-                xmin = min(coord[1] for coord in coords)
-                xmax = max(coord[1] for coord in coords)
-                ymin = min(coord[0] for coord in coords)
-                ymax = max(coord[0] for coord in coords)
-                boxes.append([xmin, ymin, xmax, ymax])
-
-        tensor = torch.tensor(boxes)
+        # Gather the geometries of all objects in the image
+        start, end = self._offsets[index : index + 2].tolist()
+        coords = cast(Tensor, self._coords)
+        pts = coords[self._rows[start:end]].numpy()
+
+        # Convert to pixel coords with a single inverse affine transform
+        inv = ~transform
+        A = np.array([[inv.a, inv.b], [inv.d, inv.e]])
+        t = np.array([inv.xoff, inv.yoff])
+        px = pts @ A.T + t
+
+        # Reduce to [xmin, ymin, xmax, ymax] before flooring, floor is monotonic
+        boxes = np.concatenate([px.min(axis=1), px.max(axis=1)], axis=1)
+        boxes = np.floor(boxes).astype(np.int64)
+
+        tensor = torch.from_numpy(boxes)
         return tensor
 
-    def _load_target(self, path: Path) -> Tensor:
+    def _load_target(self, index: int) -> Tensor:
         """Load target label for a single sample.
 
         Args:
-            path: path to image
+            index: index of the image
 
         Returns:
             the label
         """
-        # Find indices for objects in the image
-        base_path = os.path.basename(path)
-        indices = self.labels['rsFile'] == base_path
-
-        # Load object labels
-        classes = self.labels[indices]['taxonID'].tolist()
-        labels = [self.class2idx[c] for c in classes]
-        tensor = torch.tensor(labels)
+        start, end = self._offsets[index : index + 2].tolist()
+        tensor = self._targets[start:end]
         return tensor
 
     def _load(
         self, root: Path
-    ) -> tuple[list[str], dict[int, dict[str, Any]] | None, Any]:
+    ) -> tuple[
+        list[str],
+        tuple[np.typing.NDArray[np.float64], np.typing.NDArray[Any]] | None,
+        Any,
+    ]:
         """Load files, geometries, and labels.
 
         Args:
             root: root directory
 
         Returns:
-            the image path, geometries, and labels
+            the image path, geometries and their keys, and labels
         """
         if self.split == 'train':
             directory = os.path.join(root, self.directories[self.split][0])
@@ -363,6 +481,75 @@ class IDTReeS(NonGeoDataset):
 
         return images, geoms, labels
 
+    def _index_images(
+        self, keys: np.typing.NDArray[Any] | None, labels: Any
+    ) -> tuple[Tensor, Tensor, Tensor]:
+        """Index the geometries and targets of the objects in each image.
+
+        Args:
+            keys: the key of each geometry returned by :meth:`_load_geometries`
+            labels: a pandas DataFrame containing the labels for each image
+
+        Returns:
+            a [len(images) + 1] tensor of offsets, and tensors of geometry rows and
+            targets, the objects of image i are stored at ``offsets[i]:offsets[i + 1]``
+        """
+        img2rows: dict[str, list[int]] = {}
+        img2targets: dict[str, list[int]] = {}
+
+        # The train set geometry->image mapping is contained
+        # in the train/Field/itc_rsFile.csv file
+        if self.split == 'train' and keys is not None:
+            id2row = {i: row for row, i in enumerate(keys.tolist())}
+            for base_path, i, target in zip(
+                labels['rsFile'].tolist(),
+                labels['id'].tolist(),
+                labels['taxon_idx'].tolist(),
+            ):
+                # Skip individuals without a geometry, e.g. those that are not
+                # mapped to an image and have a NaN id
+                if i not in id2row:
+                    continue
+                img2rows.setdefault(base_path, []).append(id2row[i])
+                img2targets.setdefault(base_path, []).append(target)
+        # The test set has no mapping csv. The mapping is inside of the geometry
+        # properties i.e. geom["property"]["plotID"] contains the RGB image filename
+        elif keys is not None:
+            for row, base_path in enumerate(keys.tolist()):
+                img2rows.setdefault(base_path, []).append(row)
+
+        offsets = [0]
+        rows: list[int] = []
+        targets: list[int] = []
+        for path in self.images:
+            base_path = os.path.basename(path)
+            rows.extend(img2rows.get(base_path, []))
+            targets.extend(img2targets.get(base_path, []))
+            offsets.append(len(rows))
+
+        return (
+            torch.tensor(offsets),
+            torch.tensor(rows, dtype=torch.long),
+            torch.tensor(targets, dtype=torch.long),
+        )
+
+    def _sibling_path(self, path: str, modality: str) -> str:
+        """Find the path of another modality of an RGB image.
+
+        Args:
+            path: path to RGB .tif file
+            modality: one of 'HSI', 'CHM', or 'LAS'
+
+        Returns:
+            the path to the same sample in *modality*
+        """
+        # Only replace the innermost RGB directory, parent directories may contain RGB
+        directory, filename = os.path.split(path)
+        directory = os.path.join(os.path.dirname(directory), modality)
+        if modality == 'LAS':
+            filename = os.path.splitext(filename)[0] + '.las'
+        return os.path.join(directory, filename)
+
     def _load_labels(self, directory: Path) -> Any:
         """Load the csv files containing the labels.
 
@@ -379,34 +566,55 @@ class IDTReeS(NonGeoDataset):
         df_mapping = df_mapping.set_index('indvdID', drop=True)
         df_labels = df_labels.set_index('indvdID', drop=True)
         df = df_labels.join(df_mapping, on='indvdID')
-        df = df.drop_duplicates()
-        df.reset_index()
+        # Only the object, its image, and its species are used, so only hash those
+        df = df.drop_duplicates(subset=['id', 'rsFile', 'taxonID'])
+        df['taxon_idx'] = df['taxonID'].map(self.class2idx).astype(np.int64)
         return df
 
-    def _load_geometries(self, directory: Path) -> dict[int, dict[str, Any]]:
+    def _load_geometries(
+        self, directory: Path
+    ) -> tuple[np.typing.NDArray[np.float64], np.typing.NDArray[Any]]:
         """Load the shape files containing the geometries.
 
         Args:
             directory: directory containing .shp files
 
         Returns:
-            a dict containing the geometries for each object
+            a [N, 4, 2] array of the corner coordinates of each object and a [N,]
+            array of keys, the unique object id for the train set or the RGB image
+            filename for the test set
         """
         filepaths = glob.glob(os.path.join(directory, 'ITC', '*.shp'))
 
-        i = 0
-        features: dict[int, dict[str, Any]] = {}
+        # The train set has a unique id for each geometry in the properties
+        # The test set has no unique id, the properties contain the image filename
+        key = 'id' if self.split == 'train' else 'plotID'
+
+        try:
+            pyogrio = lazy_import('pyogrio.raw')
+        except DependencyNotFoundError:
+            pyogrio = None
+
+        coords = [np.empty((0, 4, 2))]
+        keys = [np.empty(0, dtype=object)]
         for path in filepaths:
-            with fiona.open(path) as src:
-                for feature in src:
-                    # The train set has a unique id for each geometry in the properties
-                    if self.split == 'train':
-                        features[feature['properties']['id']] = feature
-                    # The test set has no unique id so create a dummy id
-                    else:
-                        features[i] = feature
-                        i += 1
-        return features
+            if pyogrio is None:
+                with fiona.open(path) as src:
+                    features = list(src)
+                geoms = [
+                    feature['geometry']['coordinates'][0][:4] for feature in features
+                ]
+                coords.append(np.array(geoms, dtype=np.float64).reshape(-1, 4, 2))
+                keys.append(np.array([f['properties'][key] for f in features]))
+            else:
+                # Read all features with a single call instead of one at a time
+                _, _, geoms, fields = pyogrio.read(path, columns=[key])
+                polygons = [wkb.loads(geom) for geom in geoms]
+                exteriors = [np.asarray(p.exterior.coords)[:4, :2] for p in polygons]
+                coords.append(np.array(exteriors, dtype=np.float64).reshape(-1, 4, 2))
+                keys.append(fields[0])
+
+        return np.concatenate(coords), np.concatenate(keys)
 
     @overload
     def _filter_boxes(
@@ -436,15 +644,92 @@ class IDTReeS(NonGeoDataset):
         Returns:
             a tuple of filtered boxes and labels
         """
-        boxes = clip_boxes_to_image(boxes=boxes, size=image_size)
-        indices = remove_small_boxes(boxes=boxes, min_size=min_size)
+        h, w = image_size
+        boxes = boxes.clamp(min=boxes.new_zeros(4), max=boxes.new_tensor([w, h, w, h]))
+        widths = boxes[:, 2] - boxes[:, 0]
+        heights = boxes[:, 3] - boxes[:, 1]
+        mask = (widths >= min_size) & (heights >= min_size)
 
-        boxes = boxes[indices]
+        boxes = boxes[mask]
         if labels is not None:
-            labels = labels[indices]
+            labels = labels[mask]
 
         return boxes, labels
 
+    def _cache_path(self, path: Path, modality: str) -> str:
+        """Find the path of the cached copy of a file.
+
+        Args:
+            path: path to .tif or .las file
+            modality: one of 'RGB', 'HSI', 'CHM', or 'LAS'
+
+        Returns:
+            the path to the cached file, images are keyed by their size
+        """
+        root = os.path.splitext(path)[0]
+        if modality == 'LAS':
+            return root + '.pt'
+        height, width = self.image_sizes[modality]
+        return f'{root}_{height}x{width}.npy'
+
+    def _write_cache(
+        self, path: str, obj: np.typing.NDArray[Any] | Tensor | dict[str, Any]
+    ) -> None:
+        """Write a cache file atomically.
+
+        Args:
+            path: path to the cached file
+            obj: an array saved as .npy, a tensor saved as .pt, or a dict saved as .json
+        """
+        # Write to a temporary file first so that an interrupted run never leaves a
+        # partial file behind, the pid keeps DataLoader workers from clashing
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            if isinstance(obj, Tensor):
+                torch.save(obj, f)
+            elif isinstance(obj, np.ndarray):
+                np.save(f, obj)
+            else:
+                f.write(json.dumps(obj).encode())
+        os.replace(tmp_path, path)
+
+    def _materialize_cache(self) -> None:
+        """Decode every image and point cloud once and store it in a fast format.
+
+        RGB, HSI, and CHM images are stored as .npy files and LAS point clouds
+        are stored as .pt files next to the original files. The affine transform
+        and bounds of each RGB image are stored as a .json file, so that files
+        that are already cached are not opened again.
+        """
+        self._transforms: list[Affine] = []
+        self._bounds: list[BoundingBox] = []
+        for index, path in enumerate(self.images):
+            georef_path = os.path.splitext(path)[0] + '.json'
+            if os.path.exists(georef_path):
+                with open(georef_path) as f:
+                    georef = json.load(f)
+                transform = Affine(*georef['transform'])
+                bounds = BoundingBox(*georef['bounds'])
+            else:
+                with rasterio.Env(**self._gdal_config), rasterio.open(path) as src:
+                    transform, bounds = src.transform, src.bounds
+                    if not os.path.exists(self._cache_path(path, 'RGB')):
+                        self._load_image(path, 'RGB', src)
+                georef = {'transform': list(transform)[:6], 'bounds': list(bounds)}
+                self._write_cache(georef_path, georef)
+            self._transforms.append(transform)
+            self._bounds.append(bounds)
+
+            for modality, image_path in [
+                ('RGB', path),
+                ('HSI', self.hsi_paths[index]),
+                ('CHM', self.chm_paths[index]),
+            ]:
+                if not os.path.exists(self._cache_path(image_path, modality)):
+                    self._load_image(image_path, modality)
+            if not os.path.exists(self._cache_path(self.las_paths[index], 'LAS')):
+                self._load_las(self.las_paths[index], bounds)
+
     def _verify(self) -> None:
         """Verify the integrity of the dataset."""
         url = self.metadata[self.split]['url']
@@ -567,21 +852,159 @@ class IDTReeS(NonGeoDataset):
 
         .. versionchanged:: 0.4
            Ported from Open3D to PyVista, *colormap* parameter removed.
+
+        .. versionchanged:: 0.7
+           The point cloud is cropped to the extent of the RGB image, like the
+           point cloud returned by :meth:`__getitem__`.
         """
         laspy = lazy_import('laspy')
         pyvista = lazy_import('pyvista')
-        path = self.images[index]
-        path = path.replace('RGB', 'LAS').replace('.tif', '.las')
-        las = laspy.read(path)
+        with rasterio.Env(**self._gdal_config), rasterio.open(self.images[index]) as f:
+            bounds = f.bounds
+        las = laspy.read(self.las_paths[index])
+        mask = self._las_mask(np.asarray(las.x), np.asarray(las.y), bounds)
         points: np.typing.NDArray[np.int_] = np.stack(
-            [las.x, las.y, las.z], axis=0
+            [las.x[mask], las.y[mask], las.z[mask]], axis=0
         ).transpose((1, 0))
         point_cloud = pyvista.PolyData(points)
 
         # Some point cloud files have no color->points mapping
         if hasattr(las, 'red'):
-            colors = np.stack([las.red, las.green, las.blue], axis=0)
+            colors = np.stack([las.red[mask], las.green[mask], las.blue[mask]], axis=0)
             colors = colors.transpose((1, 0)) / np.iinfo(np.uint16).max
             point_cloud['colors'] = colors
 
         return point_cloud
+
+
+class IDTReeSPrefetcher:
+    """Prefetch batches of an IDTReeS data loader onto the GPU.
+
+    While the current batch is in use, the next batch is pinned and copied to the
+    device on a separate CUDA stream so that the transfer overlaps with compute.
+    Tensors nested in dicts, lists, and tuples are transferred, which supports
+    collation functions that keep variable size boxes and point clouds in lists.
+    On a non-CUDA device, batches are moved to the device without prefetching.
+
+    With *channels_last*, batched images are converted to the
+    :attr:`torch.channels_last` memory format during the copy, which is preferred
+    by convolutions on recent GPUs.
+
+    Create the data loader with ``pin_memory=True`` so that batches are pinned by
+    the data loader, otherwise they are pinned synchronously on the training thread
+    before each copy.
+
+    Example:
+        >>> loader = DataLoader(IDTReeS(), batch_size=1, num_workers=4, pin_memory=True)
+        >>> for batch in IDTReeSPrefetcher(loader):
+        ...     model(batch['image'])
+
+    .. versionadded:: 0.7
+    """
+
+    def __init__(
+        self,
+        loader: DataLoader[dict[str, Any]],
+        device: torch.device | str = 'cuda',
+        channels_last: bool = False,
+    ) -> None:
+        """Initialize a new IDTReeSPrefetcher instance.
+
+        Args:
+            loader: data loader to prefetch batches from
+            device: device to move batches to
+            channels_last: if True, convert 4D tensors to channels last memory format
+        """
+        self.loader = loader
+        self.device = torch.device(device)
+        self.channels_last = channels_last
+        self.stream: torch.cuda.Stream | None = None
+        if self.device.type == 'cuda':
+            self.stream = torch.cuda.Stream(self.device)  # type: ignore[no-untyped-call]
+
+    def __iter__(self) -> Iterator[Any]:
+        """Iterate over the batches of the data loader.
+
+        Yields:
+            batches on the device, ready to be used on the current stream
+        """
+        if self.stream is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+
+        iterator = iter(self.loader)
+        batch = self._preload(iterator)
+        while batch is not None:
+            if self.stream is not None:
+                current_stream.wait_stream(self.stream)
+                # Keep the allocator from reusing memory still in use by the stream
+                self._apply(batch, lambda x: x.record_stream(current_stream))
+
+            next_batch = self._preload(iterator)
+            yield batch
+            batch = next_batch
+
+    def __len__(self) -> int:
+        """Return the number of batches in the data loader.
+
+        Returns:
+            number of batches
+        """
+        return len(self.loader)
+
+    def _preload(self, iterator: Iterator[Any]) -> Any:
+        """Start copying the next batch to the device.
+
+        Args:
+            iterator: data loader iterator
+
+        Returns:
+            the next batch, or None if the data loader is exhausted
+        """
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+
+        with torch.cuda.stream(self.stream):
+            return self._apply(batch, self._transfer)
+
+    def _transfer(self, tensor: Tensor) -> Tensor:
+        """Copy a single tensor to the device.
+
+        Args:
+            tensor: tensor on the CPU
+
+        Returns:
+            the tensor on the device
+        """
+        memory_format = torch.preserve_format
+        if self.channels_last and tensor.ndim == 4:
+            memory_format = torch.channels_last
+
+        if self.stream is None:
+            return tensor.to(self.device, memory_format=memory_format)
+
+        # Copies are only asynchronous from pinned memory
+        if not tensor.is_pinned():
+            tensor = tensor.pin_memory()
+        return tensor.to(self.device, non_blocking=True, memory_format=memory_format)
+
+    def _apply(self, data: Any, fn: Callable[[Tensor], Any]) -> Any:
+        """Apply a function to every tensor in a nested batch.
+
+        Args:
+            data: a tensor, or a dict, list, or tuple containing tensors
+            fn: function to apply to each tensor
+
+        Returns:
+            *data* with *fn* applied to each tensor
+        """
+        if isinstance(data, Tensor):
+            return fn(data)
+        elif isinstance(data, Mapping):
+            return {key: self._apply(value, fn) for key, value in data.items()}
+        elif isinstance(data, tuple) and hasattr(data, '_fields'):  # namedtuple
+            return type(data)(*(self._apply(value, fn) for value in data))
+        elif isinstance(data, list | tuple):
+            return type(data)(self._apply(value, fn) for value in data)
+        return data